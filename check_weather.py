@@ -1,19 +1,23 @@
-import io
-import json
+import fire
 import logging
-import matplotlib
+import orjson
 import os
 import requests
+import signal
 import textwrap
-import xmltodict
+import threading
 
 from co2_samples import *
 
+from appdirs import user_cache_dir
 from datetime import datetime, timedelta, date
 from dateutil import tz as tz
+from functools import lru_cache
 from inky.auto import auto
-from matplotlib import pyplot as plt
+from lxml import etree
+from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont, ImageColor
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
@@ -25,33 +29,61 @@ SUBWAY_MAP = r'Subway_Map.jpg'
 
 TRUETYPE_FONT = r'/usr/share/fonts/truetype/noto/NotoSansMono-Regular.ttf'
 
+# How often to redraw the display when running with --loop.
+REFRESH_SEC = 5 * 60
+
+# Paths into an MTA OTP arrival group, see find().
+_PATH_HEADSIGN = ('headsign',)
+_PATH_ROUTE_ID = ('route', 'id')
+
+BOX_FILL = ImageColor.getrgb("#C0FFEE")
+BOX_OUTLINE = ImageColor.getrgb("#D1E")
+TEXT_FILL = ImageColor.getrgb("#007")
+
 MTA_7_URL = r'https://otp-mta-prod.camsys-apps.com/otp/routers/default/nearby?stops=MTASBWY:721&apikey=2ctbNX4XX7oS5ywqVQT86DntRQQw59eB&groupByParent=true&routes=&timeRange=3600'
 
 MTA_G_URL = r'https://otp-mta-prod.camsys-apps.com/otp/routers/default/nearby?stops=MTASBWY:G24&apikey=2ctbNX4XX7oS5ywqVQT86DntRQQw59eB&groupByParent=true&routes=&timeRange=3600'
 
+# Shared session so repeated requests to the same host reuse a keep-alive
+# connection instead of paying for a fresh TCP+TLS handshake each time.
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_maxsize=8))
+SESSION.mount('https://', HTTPAdapter(pool_maxsize=8))
+
 def fetch_json(url):
-    response = requests.get(url)
-    return json.loads(response.content)
+    response = SESSION.get(url, timeout=5)
+    return orjson.loads(response.content)
 
 def fetch_xml(url):
-    response = requests.get(url)
-    return xmltodict.parse(response.content)
-
-def overlay_timestamp(draw, font_size, offset):
+    """ Fetch and parse an XML document, returning the lxml root element. """
+    response = SESSION.get(url, timeout=5)
+    return etree.fromstring(response.content)
+
+@lru_cache(maxsize=8)
+def _font(size):
+    return ImageFont.truetype(TRUETYPE_FONT, size)
+
+@lru_cache(maxsize=1)
+def _timestamp_badge():
+    """ The empty box behind the timestamp, drawn once and pasted per frame. """
+    badge = Image.new("RGB", (141, 41), BOX_FILL)
+    ImageDraw.Draw(badge).rectangle([(0, 0), (140, 40)], fill=BOX_FILL, outline=BOX_OUTLINE)
+    return badge
+
+def overlay_timestamp(im, font_size, offset):
     est = tz.gettz('America/New_York')
     now = datetime.now(est)
-    font = ImageFont.truetype(TRUETYPE_FONT, font_size)
+    font = _font(font_size)
     date_string = now.strftime("%H:%M:%S")
-    draw.rectangle([offset, (offset[0] + 140, offset[1] + 40)],
-                   fill=ImageColor.getrgb("#C0FFEE"),
-                   outline=ImageColor.getrgb("#D1E"))
-    draw.text((offset[0] + 5, offset[1]), date_string, font=font, align="left", fill=ImageColor.getrgb("#007"))
+    im.paste(_timestamp_badge(), offset)
+    draw = ImageDraw.Draw(im)
+    draw.text((offset[0] + 5, offset[1]), date_string, font=font, align="left", fill=TEXT_FILL)
 
 def overlay_train_group(draw, group, y_offset, font_size=25):
     """ A group is a combo of (route, destination). """
     # First, let's grab the destination and route name.
-    destination = find("headsign", group)
-    route_id = find("route.id", group)
+    destination = find(_PATH_HEADSIGN, group)
+    route_id = find(_PATH_ROUTE_ID, group)
     route = route_id.split(":")[1]
 
     # Now, let's collect arrival times.
@@ -67,7 +99,7 @@ def overlay_train_group(draw, group, y_offset, font_size=25):
         time_str = (timedelta(seconds=time))
         arrival = start + timedelta(seconds=time)
         if now + timedelta(minutes=3) > arrival:
-            print(f"Ignoring arrival too soon: {arrival}")
+            logger.debug("Ignoring arrival too soon: %s", arrival)
             continue
         arrival_string = arrival.strftime(":%M") if last_time.hour == arrival.hour else arrival.strftime("%I:%M")
         if last_time == datetime.min:
@@ -79,52 +111,81 @@ def overlay_train_group(draw, group, y_offset, font_size=25):
     width = 330
     padding_x = 5
     padding_y = 5
-    height = font_size + padding_y * 2
     group_summary = f"{destination} ({route}) | {', '.join(arrival_strings)}"
     lines = textwrap.wrap(group_summary, width=27)
-    font = ImageFont.truetype(TRUETYPE_FONT, font_size)
-    text_height = sum([font.getsize(line)[1] for line in lines])
-    height = text_height + padding_y * 2
+    font = _font(font_size)
+    # Every line uses the same font, so one line height covers all of them.
+    (ascent, descent) = font.getmetrics()
+    line_height = ascent + descent
+    height = line_height * len(lines) + padding_y * 2
     draw.rectangle([(x_offset, y_offset), (x_offset + width, y_offset + height)],
-                   fill=ImageColor.getrgb("#C0FFEE"),
-                   outline=ImageColor.getrgb("#D1E"))
+                   fill=BOX_FILL,
+                   outline=BOX_OUTLINE)
+    y = y_offset + padding_y
     for line in lines:
-        draw.text((x_offset + padding_x, y_offset + padding_y), line, font=font, align="left", fill=ImageColor.getrgb("#007"))
-        y_offset += font.getsize(line)[1]
-    print(group_summary)
+        draw.text((x_offset + padding_x, y), line, font=font, align="left", fill=TEXT_FILL)
+        y += line_height
+    logger.debug("%s", group_summary)
     return height
 
+def resize_image(im, size):
+    """ Resize an image to size, shrinking by an integer factor first when possible.
+
+    For JPEGs, draft() lets libjpeg decode directly at a reduced scale, and
+    reducing_gap lets Pillow do a cheap box reduce before the final resample.
+    """
+    im.draft('RGB', size)
+    return im.resize(size, reducing_gap=3.0)
+
+@lru_cache(maxsize=1)
+def _load_base_map(resolution):
+    """ Load the subway map resized to resolution.
+
+    The resized map is cached as a PNG in the cache directory and only rebuilt
+    when the source map is newer than the cached copy. The decoded image is
+    also kept in memory, so a long-running process only decodes it once.
+    """
+    cache_dir = user_cache_dir(CACHE_DIR)
+    Path(cache_dir).mkdir(exist_ok=True)
+    (width, height) = resolution
+    cache_file = f"{cache_dir}/subway_{width}x{height}.png"
+    if not os.path.exists(cache_file) or os.path.getmtime(cache_file) < os.path.getmtime(SUBWAY_MAP):
+        with Image.open(SUBWAY_MAP) as im:
+            resize_image(im, resolution).save(cache_file, 'PNG')
+    with Image.open(cache_file) as im:
+        return im.convert('RGB')
+
+def _get_base_map(resolution):
+    """ Return a fresh frame to draw on, starting from the resized subway map. """
+    return _load_base_map(resolution).copy()
+
 def overlay_image(bg_image, fg_image, offset):
     bg_image.paste(im=fg_image, box=offset)
 
 def find(element, obj):
-    """ Use a period-separated path to index elements in a nested dictionary. """
-    keys = element.split('.')
+    """ Use a path to index elements in a nested dictionary.
+
+    The path is either a period-separated string or a tuple of keys; passing a
+    precomputed tuple skips splitting the string on every call.
+    """
+    keys = element if isinstance(element, tuple) else element.split('.')
     rv = obj
     for key in keys:
         rv = rv[key]
     return rv
 
-def image_from_plt_fig(fig):
-    buf = io.BytesIO()
-    fig.savefig(buf)
-    buf.seek(0)
-    return Image.open(buf)
-
-def main():
-    logging.basicConfig(level=logging.INFO)
-    display = auto()
+def refresh(display):
+    """ Poll the CO2 sensor and redraw the display once. """
     refresh_co2_ppm_cache()
     co2_ppm_samples = get_co2_ppm_cache()
     # Filter only samples from the last week.
     est = tz.gettz('America/New_York')
-    co2_ppm_samples = [sample for sample in co2_ppm_samples if (datetime.now(est) - sample.timestamp) < timedelta(hours=120)]
+    cutoff = datetime.now(est) - timedelta(hours=120)
+    co2_ppm_samples = [sample for sample in co2_ppm_samples if sample.timestamp > cutoff]
     if len(co2_ppm_samples) == 0:
         logger.info(f"No sensor samples to graph.")
         return
-    co2_ppm_graph_buf = co2_ppm_graph_image(co2_ppm_samples)
-    co2_ppm_graph = Image.open(co2_ppm_graph_buf)
-    co2_ppm_graph = co2_ppm_graph.resize(display.resolution)
+    co2_ppm_graph = co2_ppm_graph_image(co2_ppm_samples, resolution=display.resolution)
 
     # Note: This code has been commented out. Smart plugs have been repurposed for
     # controlling lights.
@@ -132,18 +193,36 @@ def main():
     # If the CO2 PPM has fallen below 600, we can shut the fan off.
     # Numbers updated after Lexie movin to better accomodate 2 people.
     # if co2_ppm_samples[-1].co2_ppm > 1100:
-    #     requests.get(url="http://192.168.0.190/relay/0?turn=on")
+    #     SESSION.get(url="http://192.168.0.190/relay/0?turn=on", timeout=2)
     # elif co2_ppm_samples[-1].co2_ppm < 600:
-    #     requests.get(url="http://192.168.0.190/relay/0?turn=off")
+    #     SESSION.get(url="http://192.168.0.190/relay/0?turn=off", timeout=2)
+
+    im = _get_base_map(display.resolution)
+    overlay_image(im, co2_ppm_graph, (0, 0))
+    overlay_timestamp(im, font_size=25, offset=(450, 10))
+    display.set_image(im)
+    display.show()
+
+def main(loop=False, refresh_sec=REFRESH_SEC):
+    """ Refresh the display once, or every refresh_sec seconds if loop is set.
 
-    with Image.open(SUBWAY_MAP) as im:
-        im = im.resize(display.resolution)
-        overlay_image(im, co2_ppm_graph, (0, 0))
-        draw = ImageDraw.Draw(im)
-        overlay_timestamp(draw, font_size=25, offset=(450, 10))
-        display.set_image(im)
-        display.show()
+    Looping keeps the imports, HTTP session, display handle and cached images
+    alive between refreshes instead of paying for them on every run.
+    """
+    logging.basicConfig(level=logging.INFO)
+    display = auto()
+    if not loop:
+        refresh(display)
+        return
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    while not stop.is_set():
+        try:
+            refresh(display)
+        except Exception:
+            logger.exception("Refresh failed.")
+        stop.wait(refresh_sec)
 
 
 if __name__ == "__main__":
-    main()
+    fire.Fire(main)
@@ -1,19 +1,25 @@
+import heapq
 import logging
-import io
 import os
 import requests
+import threading
 
-import matplotlib
-import matplotlib.pyplot as plt
-import seaborn as sns
+import numpy as np
 
 from appdirs import user_cache_dir
 from dataclasses import dataclass
 from datetime import datetime, timedelta, date
-from dateutil import tz as tz
+from functools import lru_cache
+from operator import attrgetter
 from pathlib import Path
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from zoneinfo import ZoneInfo
 
-est = tz.gettz('America/New_York')
+# zoneinfo's C implementation converts to and from epoch seconds an order of
+# magnitude faster than dateutil's tzfile, which matters with one conversion
+# per sample.
+est = ZoneInfo('America/New_York')
 
 logger = logging.getLogger(__name__)
 
@@ -23,21 +29,62 @@ CACHE_DIR = r'home_station'
 # root url.
 CO2_PPM_URL = r'http://esp32.local/'
 CO2_PPM_CACHE = r'co2_ppm_samples.csv'
+# Rotated cache files are immutable, so they are archived in a columnar binary
+# format that loads without any per-row parsing.
+CO2_PPM_ARCHIVE_SUFFIX = r'.npy'
+# One column per Co2Sample field, with timestamps as seconds since the epoch.
+CO2_SAMPLE_DTYPE = np.dtype([
+    ('timestamp', 'i8'),
+    ('co2_ppm', 'f8'),
+    ('temp_c', 'f8'),
+    ('rel_humidity', 'f8'),
+])
+
+# Keep-alive session for polling the ESP32, so repeated polls from a
+# long-running process reuse the same connection.
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+# Most points plotted per series by co2_ppm_graph_image.
+GRAPH_MAX_POINTS = 2000
 
 @dataclass
 class Co2Sample:
+  # Declared by hand rather than with dataclass(slots=True), which needs 3.10.
+  __slots__ = ('timestamp', 'co2_ppm', 'temp_c', 'rel_humidity')
   timestamp: datetime
   co2_ppm: float
   temp_c: float
   rel_humidity: float
 
+def _parse_sensor_timestamp(timestamp_str):
+    """ Parse a sensor timestamp. D/M/Y H:M:S (TZ)
+
+    The sensor zero-pads every field, so slicing them out is much cheaper than
+    strptime. Anything that doesn't fit that layout falls back to strptime.
+    """
+    s = timestamp_str
+    if len(s) > 19 and s[2] == '/' and s[5] == '/' and s[13] == ':' and s[16] == ':':
+        return datetime(int(s[6:10]), int(s[3:5]), int(s[0:2]),
+                        int(s[11:13]), int(s[14:16]), int(s[17:19]), tzinfo=est)
+    return datetime.strptime(s, "%d/%m/%Y %H:%M:%S (%Z)").replace(tzinfo=est)
+
 def parse_sample(sample_str):
     try:
         (timestamp_str, co2_ppm_str, temp_c, rel_humidity) = sample_str.split(",")
     except ValueError as e:
         logger.info(f"Could not parse line {sample_str}: {e}")
         return None
-    logger.info(f"Received: {sample_str}")
+    if timestamp_str.isdigit():
+        # Rows written to the cache: epoch seconds followed by bare numbers.
+        try:
+            return Co2Sample(datetime.fromtimestamp(int(timestamp_str), est),
+                             float(co2_ppm_str), float(temp_c), float(rel_humidity))
+        except (ValueError, OverflowError, OSError) as e:
+            # A corrupt row can carry an epoch too large for a datetime.
+            logger.error(f"Could not parse sample: {sample_str}: {e}")
+            return None
+    # Rows from the sensor (and older caches): D/M/Y H:M:S (TZ) with units.
     try:
         co2_ppm_str = co2_ppm_str.strip()
         (co2_ppm, unit) = co2_ppm_str.split(" ")
@@ -47,96 +94,243 @@ def parse_sample(sample_str):
         (rel_humidity, _) = rel_humidity_str.split(" ")
         if unit != "ppm":
             return None
-        # Parse the timestamp. D/M/Y H:M:S
-        timestamp = datetime.strptime(str(timestamp_str), "%d/%m/%Y %H:%M:%S (%Z)")
-        NYC = tz.gettz("America/New_York")
-        timestamp = timestamp.replace(tzinfo=NYC)
+        timestamp = _parse_sensor_timestamp(timestamp_str)
         return Co2Sample(timestamp, float(co2_ppm), float(temp_c), float(rel_humidity))
     except ValueError as e:
         logger.error(f"Could not parse sample: {sample_str}: {e}")
         return None
 
 def refresh_co2_ppm_cache():
+    samples = []
     try:
-        response = requests.get(CO2_PPM_URL)
+        # Stream the response so lines are parsed as they arrive rather than
+        # after the whole body has been buffered.
+        with _SESSION.get(CO2_PPM_URL, stream=True, timeout=(2, 5)) as response:
+            response.encoding = "utf-8"
+            for sample_str in response.iter_lines(decode_unicode=True):
+                sample_str = sample_str.strip()
+                # Lazy %-formatting so the per-line message costs nothing unless
+                # debug logging is enabled.
+                logger.debug("Received: %s", sample_str)
+                sample = parse_sample(sample_str)
+                if sample is None:
+                    continue
+                samples.append(sample)
     except requests.exceptions.RequestException as e:
         logger.error(e)
         return
-
-    samples = []
-    response_lines = response.content.split(b"\n")
-    for sample_str in response_lines:
-        sample_str = sample_str.decode("utf-8").strip()
-        sample = parse_sample(sample_str)
-        if sample is None:
-            continue
-        samples.append(sample)
-    # If the cache file doesn't exist, create it.
+    logger.info(f"Received {len(samples)} samples.")
     cache_dir = user_cache_dir(CACHE_DIR)
     Path(cache_dir).mkdir(exist_ok=True)
     cache_file = f"{cache_dir}/{CO2_PPM_CACHE}"
-    if not os.path.exists(cache_file):
-        with open(cache_file, 'w') as f:
-            pass # Empty file.
-    # Append the samples to a cache file.
+    # Append the samples to the cache file through one buffered writelines()
+    # call, formatting rows as they are consumed. Append mode creates the file
+    # if it doesn't exist yet.
     with open(cache_file, 'a') as f:
-        for sample in samples:
-            f.write(sample.timestamp.strftime("%d/%m/%Y %H:%M:%S (%Z)") + f",{sample.co2_ppm} ppm,{sample.temp_c} C,{sample.rel_humidity} rel_humidity\n")
+        f.writelines(f"{int(sample.timestamp.timestamp())},{sample.co2_ppm},{sample.temp_c},{sample.rel_humidity}\n"
+                     for sample in samples)
     # If the file is larger than 5MB, rename it and start a new one.
-    if os.path.getsize(cache_file) > 5 * 1024 * 1024:
-        os.rename(cache_file, f"{cache_file}.{datetime.now(est).strftime('%Y%m%dT%H%M%S')}")
+    if os.stat(cache_file).st_size > 5 * 1024 * 1024:
+        rotated_file = f"{cache_file}.{datetime.now(est).strftime('%Y%m%dT%H%M%S')}"
+        os.rename(cache_file, rotated_file)
         with open(cache_file, 'w') as f:
             pass # Empty file.
+        # This also picks up files rotated before rotations were archived. If
+        # archiving fails, the rotated text file stays and is retried next time.
+        try:
+            _archive_rotated_files(cache_dir)
+        except Exception:
+            logger.exception("Could not archive rotated cache files")
 
-def get_co2_ppm_cache():
+def _parse_cache_lines(contents):
+    """ Parse every valid sample in a chunk of cache file text. """
     results = []
+    for sample_str in contents.splitlines():
+        sample = parse_sample(sample_str)
+        if sample is None:
+            continue
+        results.append(sample)
+    return results
+
+def _read_cache_file(path):
+    """ Parse every valid sample in a cache file. """
+    # Read and decode the whole file in one go; splitting the decoded text is
+    # much cheaper than pulling it through the text layer line by line.
+    with open(path, 'rb') as f:
+        return _parse_cache_lines(f.read().decode("utf-8"))
+
+def _samples_to_array(samples):
+    """ Pack samples into a structured array with one column per field. """
+    return np.array(
+        [(int(s.timestamp.timestamp()), s.co2_ppm, s.temp_c, s.rel_humidity) for s in samples],
+        dtype=CO2_SAMPLE_DTYPE)
+
+def _archive_cache_file(path):
+    """ Convert a rotated cache file into a binary archive and remove the original.
+
+    The archive is written under a temporary name and renamed into place, so a
+    crash never leaves a partial archive behind. If the archive already exists
+    (an earlier run died before removing the original), it is kept as is.
+    """
+    archive_path = f"{path}{CO2_PPM_ARCHIVE_SUFFIX}"
+    if not os.path.exists(archive_path):
+        archive = _samples_to_array(_read_cache_file(path))
+        with open(f"{archive_path}.tmp", 'wb') as f:
+            np.save(f, archive)
+        os.replace(f"{archive_path}.tmp", archive_path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass # Another process archived it first.
+
+def _archive_rotated_files(cache_dir):
+    """ Archive every rotated cache file that is still plain text. """
+    with os.scandir(cache_dir) as it:
+        paths = [entry.path for entry in it
+                 if not entry.name.endswith(CO2_PPM_ARCHIVE_SUFFIX) and _rotation_time(entry.name) is not None]
+    for path in paths:
+        _archive_cache_file(path)
+
+def _read_archive_files(paths):
+    """ Load binary archives written by _archive_cache_file.
+
+    The archives are concatenated and sorted by timestamp as arrays, so
+    samples are only built once, already in time order.
+    """
+    if not paths:
+        return []
+    archive = np.concatenate([np.load(path) for path in paths])
+    archive = archive[np.argsort(archive['timestamp'], kind='stable')]
+    return [Co2Sample(datetime.fromtimestamp(timestamp, est), co2_ppm, temp_c, rel_humidity)
+            for (timestamp, co2_ppm, temp_c, rel_humidity) in archive.tolist()]
+
+# The parsed live cache. The file is only ever appended to, so later calls
+# only parse the bytes added since the previous one.
+_co2_ppm_cache_lock = threading.Lock()
+_co2_ppm_cache = {'inode': None, 'offset': 0, 'samples': []}
+
+def get_co2_ppm_cache():
     cache_dir = user_cache_dir(CACHE_DIR)
     cache_file = f"{cache_dir}/{CO2_PPM_CACHE}"
-    with open(cache_file, 'r') as f:
-        for sample_str in f.readlines():
-            sample = parse_sample(sample_str)
-            if sample is None:
-                continue
-            results.append(sample)
-    # Sort the results by time.
-    results.sort(key=lambda x: x.timestamp)
-    return results
+    with _co2_ppm_cache_lock:
+        with open(cache_file, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != _co2_ppm_cache['inode'] or st.st_size < _co2_ppm_cache['offset']:
+                # The file was rotated or replaced, start over.
+                _co2_ppm_cache.update(inode=st.st_ino, offset=0, samples=[])
+            f.seek(_co2_ppm_cache['offset'])
+            appended = f.read()
+        # Leave a partially written last line for the next call.
+        end = appended.rfind(b"\n") + 1
+        if end > 0:
+            samples = _co2_ppm_cache['samples']
+            samples.extend(_parse_cache_lines(appended[:end].decode("utf-8")))
+            # Sort the results by time.
+            samples.sort(key=lambda x: x.timestamp)
+            _co2_ppm_cache['offset'] += end
+        return list(_co2_ppm_cache['samples'])
+
+def _rotation_time(filename):
+    """ The time a rotated cache file was rotated out, from its filename suffix.
+
+    Returns None if filename isn't a rotated cache file or its archive.
+    """
+    if not filename.startswith(f"{CO2_PPM_CACHE}."):
+        return None
+    suffix = filename[len(CO2_PPM_CACHE) + 1:]
+    if suffix.endswith(CO2_PPM_ARCHIVE_SUFFIX):
+        suffix = suffix[:-len(CO2_PPM_ARCHIVE_SUFFIX)]
+    try:
+        return datetime.strptime(suffix, '%Y%m%dT%H%M%S').replace(tzinfo=est)
+    except ValueError:
+        return None
 
-def get_entire_co2_ppm_cache():
+def get_entire_co2_ppm_cache(since=None):
     """ Get all CO2 ppm samples from the cache.
     
     Like get_co2_ppm_cache, but also fetches historical data from the cache
     directory and merges it.
+
+    If since is given, only samples taken after it are returned, and rotated
+    files that were rotated out before it are not read at all.
     """
-    results = []
+    text_samples = []
+    archive_paths = []
     cache_dir = user_cache_dir(CACHE_DIR)
-    cache_file = f"{cache_dir}/{CO2_PPM_CACHE}"
-    for filename in os.listdir(cache_dir):
-        if not filename.startswith(CO2_PPM_CACHE):
+    with os.scandir(cache_dir) as it:
+        entries = [entry for entry in it if entry.name.startswith(CO2_PPM_CACHE) and entry.is_file()]
+    filenames = {entry.name for entry in entries}
+    for entry in entries:
+        (filename, path) = (entry.name, entry.path)
+        if filename == CO2_PPM_CACHE:
+            text_samples.extend(_read_cache_file(path))
             continue
-        with open(f"{cache_dir}/{filename}", 'r') as f:
-            for sample_str in f.readlines():
-                sample = parse_sample(sample_str)
-                if sample is None:
-                    continue
-                results.append(sample)
-    # Sort the results by time.
-    results.sort(key=lambda x: x.timestamp)
-    return results
+        rotation_time = _rotation_time(filename)
+        if rotation_time is None:
+            # Not one of ours, e.g. a backup copy.
+            continue
+        if since is not None and rotation_time < since:
+            # Everything in this file predates since.
+            continue
+        if filename.endswith(CO2_PPM_ARCHIVE_SUFFIX):
+            archive_paths.append(path)
+        elif f"{filename}{CO2_PPM_ARCHIVE_SUFFIX}" not in filenames:
+            # A rotated file that hasn't been archived yet. The next rotation
+            # archives it; until then, parse it like the live cache.
+            text_samples.extend(_read_cache_file(path))
+    # The archives come back already sorted, so only the text samples need
+    # sorting before the two are merged.
+    text_samples.sort(key=attrgetter('timestamp'))
+    archived = _read_archive_files(archive_paths)
+    results = heapq.merge(archived, text_samples, key=attrgetter('timestamp'))
+    if since is not None:
+        results = (sample for sample in results if sample.timestamp > since)
+    return list(results)
+
+def _lttb_indices(x, y, threshold):
+    """ Pick threshold points of a series with Largest-Triangle-Three-Buckets.
+
+    The first and last points are always kept. The points in between are split
+    into buckets, and from each bucket we keep the point forming the largest
+    triangle with the previously kept point and the average of the next bucket,
+    which preserves the visual shape (including spikes) of the series.
 
-def co2_ppm_graph_image(co2_ppm_samples):
+    Returns the indices of the kept points, in order.
     """
-    Generate a graph of CO2 ppm samples, Temperature C and Relative Humidity all in the same graph.
-    Use seaborn to make the graph look nice.
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    indices = np.empty(threshold, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        (start, end) = (edges[i], edges[i + 1])
+        (next_start, next_end) = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
 
-    Graphs with more than one axis are a bit tricky to get right. The x-axis is shared between the
-    two axes, but the y-axis is not. The y-axis for the temperature and relative humidity are
-    fixed to the range 0-100, but the y-axis for the CO2 ppm is fixed to the range 0-2000.
+@lru_cache(maxsize=1)
+def _co2_ppm_figure():
     """
-    times = [-(datetime.now(est) - sample.timestamp).total_seconds()/3600 for sample in co2_ppm_samples]
-    co2_ppm = [sample.co2_ppm for sample in co2_ppm_samples]
-    temp = [sample.temp_c for sample in co2_ppm_samples]
-    rel_humidity = [sample.rel_humidity for sample in co2_ppm_samples]
+    Build the figure drawn by co2_ppm_graph_image.
+
+    The figure, axes and line artists are created once and reused, so each
+    render only has to swap in new data. The lines start out empty.
+
+    Returns (fig, ax1, co2_ppm_line, temp_line, rel_humidity_line).
+    """
+    # Plotting libraries are slow to import and only needed here, so they are
+    # imported on first use rather than by everything that reads the cache.
+    import seaborn as sns
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
     # Use seaborn.
     # Plot CO2_PPM, temperature and relative humidity on different axes.
     # Draw CO2 threshold horizontal lines at 510 and 800ppm.
@@ -146,15 +340,17 @@ def co2_ppm_graph_image(co2_ppm_samples):
     sns.set_style("darkgrid")
     # Set the color palette.
     sns.set_palette("colorblind")
-    # Set the figure size.
-    fig = plt.figure(figsize=(10, 6))
+    # Set the figure size. The figure is drawn on an Agg canvas directly and
+    # is never registered with pyplot.
+    fig = Figure(figsize=(10, 6))
+    FigureCanvasAgg(fig)
     # Create the axes.
     ax1 = fig.add_subplot(111)
     ax2 = ax1.twinx()
-    # Plot the data.
-    ax1.plot(times, co2_ppm, color="tab:blue", label="CO2 ppm")
-    ax2.plot(times, temp, color="tab:orange", label="Temperature C")
-    ax2.plot(times, rel_humidity, color="tab:green", label="Relative Humidity")
+    # Create the (empty) data lines.
+    (co2_ppm_line,) = ax1.plot([], [], color="tab:blue", label="CO2 ppm")
+    (temp_line,) = ax2.plot([], [], color="tab:orange", label="Temperature C")
+    (rel_humidity_line,) = ax2.plot([], [], color="tab:green", label="Relative Humidity")
     # Set the x-axis label.
     ax1.set_xlabel("Time (hours ago)")
     # Set the y-axis labels.
@@ -163,17 +359,57 @@ def co2_ppm_graph_image(co2_ppm_samples):
     # Set the y-axis limits.
     ax1.set_ylim(0, 2000)
     ax2.set_ylim(0, 100)
-    # Set the x-axis range. Scale it to the data.
-    ax1.set_xlim(min(times), max(times))
     # Draw the CO2 threshold lines.
     ax1.axhline(y=600, color="tab:red", linestyle="--")
     ax1.axhline(y=1100, color="tab:red", linestyle="--")
     # Set the legend.
     ax1.legend(loc="upper left")
     ax2.legend(loc="upper right")
-    # Save the figure to a buffer.
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png")
-    buf.seek(0)
-    # Return the buffer.
-    return buf
+    return (fig, ax1, co2_ppm_line, temp_line, rel_humidity_line)
+
+# The samples last packed by co2_ppm_graph_image, keyed on their count and the
+# timestamps at either end.
+_graph_samples = {'key': None, 'samples': None}
+
+def co2_ppm_graph_image(co2_ppm_samples, resolution=None):
+    """
+    Generate a graph of CO2 ppm samples, Temperature C and Relative Humidity all in the same graph.
+    Use seaborn to make the graph look nice.
+
+    Graphs with more than one axis are a bit tricky to get right. The x-axis is shared between the
+    two axes, but the y-axis is not. The y-axis for the temperature and relative humidity are
+    fixed to the range 0-100, but the y-axis for the CO2 ppm is fixed to the range 0-2000.
+
+    If resolution is given, the graph is rendered at exactly that (width, height)
+    in pixels so it doesn't need resizing afterwards; otherwise it is 1000x600.
+
+    Returns the rendered graph as an RGB PIL image.
+    """
+    # Pack the samples into columns once; everything below works on arrays.
+    # Packing dominates the cost for long histories, so the result is reused
+    # when called again with the same samples.
+    key = (len(co2_ppm_samples), co2_ppm_samples[0].timestamp, co2_ppm_samples[-1].timestamp)
+    if _graph_samples['key'] != key:
+        _graph_samples['key'] = key
+        _graph_samples['samples'] = _samples_to_array(co2_ppm_samples)
+    samples = _graph_samples['samples']
+    times = (samples['timestamp'] - datetime.now(est).timestamp()) / 3600
+    (fig, ax1, co2_ppm_line, temp_line, rel_humidity_line) = _co2_ppm_figure()
+    # Keep the figure 10 inches wide so text is laid out as at the default
+    # size, and pick the dpi and height that land on the requested pixels.
+    (width, height) = (1000, 600) if resolution is None else resolution
+    fig.set_dpi(width / 10)
+    fig.set_size_inches(10, height / fig.dpi)
+    # Plot the data. The graph is only ~1000px wide, so each series is
+    # downsampled first rather than stroking far more segments than pixels.
+    for (line, field) in ((co2_ppm_line, 'co2_ppm'), (temp_line, 'temp_c'), (rel_humidity_line, 'rel_humidity')):
+        keep = _lttb_indices(times, samples[field], GRAPH_MAX_POINTS)
+        line.set_data(times[keep], samples[field][keep])
+    # Set the x-axis range. Scale it to the data.
+    ax1.set_xlim(times.min(), times.max())
+    # Render straight into a PIL image rather than encoding a PNG only for the
+    # caller to decode it again.
+    fig.canvas.draw()
+    im = Image.frombuffer("RGBA", fig.canvas.get_width_height(), fig.canvas.buffer_rgba(), "raw", "RGBA", 0, 1).convert("RGB")
+    # Float rounding in the figure size can leave us a pixel short.
+    return im if im.size == (width, height) else im.resize((width, height))
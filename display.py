@@ -5,7 +5,18 @@ from inky.auto import auto
 from os.path import exists
 from PIL import Image, ImageDraw
 
-def display_image(display, filename=""):
+def display_image(display, filename="", image=None):
+    """ Show an image file, or an already loaded PIL image, on the display.
+
+    An in-memory image that already matches the display resolution is shown
+    as-is, without being resized.
+    """
+    if image is not None:
+        if image.size != display.resolution:
+            image = image.resize(display.resolution)
+        display.set_image(image)
+        display.show()
+        return
     if not exists(filename):
         sys.stderr.write(f"Filename {filename} does not exist.\n")
         return
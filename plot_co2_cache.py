@@ -1,16 +1,16 @@
 import logging
-import matplotlib.pyplot as plt
 
-from co2_samples import *
+from co2_samples import co2_ppm_graph_image, est, get_entire_co2_ppm_cache
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     logger.info(f"Loading cache...")
-    co2_samples = get_entire_co2_ppm_cache()
-    co2_samples = [sample for sample in co2_samples if sample.timestamp > datetime.now() - timedelta(days=3650)]
+    cutoff = datetime.now(est) - timedelta(days=3650)
+    co2_samples = get_entire_co2_ppm_cache(since=cutoff)
     logger.info(f"Plotting...")
-    fig = co2_ppm_graph_image(co2_samples)
-    # Show fig.
-    plt.show()
\ No newline at end of file
+    graph = co2_ppm_graph_image(co2_samples)
+    # Show the graph.
+    graph.show()
\ No newline at end of file